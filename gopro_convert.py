@@ -5,12 +5,26 @@ Re-encodes GoPro footage individually using NVIDIA GPU encoding
 """
 
 import os
+import re
 import sys
+import stat
+import argparse
 import subprocess
 import json
+import time
+import tempfile
+import functools
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
+
+try:
+    import PyNvVideoCodec as nvc
+except ImportError:
+    nvc = None
 
 
 class Colors:
@@ -25,31 +39,94 @@ class Colors:
     BOLD = '\033[1m'
 
 
+# Color codes are only useful on a terminal (and honor https://no-color.org)
+_USE_COLOR = sys.stdout.isatty() and os.environ.get('NO_COLOR') is None
+if not _USE_COLOR:
+    for _name in ('HEADER', 'BLUE', 'CYAN', 'GREEN', 'YELLOW', 'RED', 'END', 'BOLD'):
+        setattr(Colors, _name, '')
+
+# Message prefixes, built once instead of on every print
+_HEADER_RULE = f"{Colors.HEADER}{Colors.BOLD}{'='*60}{Colors.END}"
+_HEADER_PREFIX = f"{Colors.HEADER}{Colors.BOLD}"
+_SUCCESS_PREFIX = f"{Colors.GREEN}✓ "
+_ERROR_PREFIX = f"{Colors.RED}✗ "
+_INFO_PREFIX = f"{Colors.CYAN}ℹ "
+_WARNING_PREFIX = f"{Colors.YELLOW}⚠ "
+_END = f"{Colors.END}\n"
+
+# Default number of simultaneous NVENC sessions per GPU
+DEFAULT_NVENC_SESSIONS = 2
+
+# Concurrent NVENC sessions the driver allows on GeForce/TITAN cards
+# (conservative - newer drivers allow more). Professional cards have no cap
+CONSUMER_NVENC_SESSION_LIMIT = 3
+
+# NVENC codecs the PyNvVideoCodec backend can write as an elementary stream
+PYNVC_CODECS = {'h264_nvenc': 'h264', 'hevc_nvenc': 'hevc'}
+
+# Pascal (and older Maxwell) GPUs have no HEVC B-frames or B-frame references
+LEGACY_NVENC_GPU_PATTERN = re.compile(r'GTX (7[45]0|9[5-8]0|10[5-8]0)|TITAN X|Quadro [MP]\d|Tesla [MP]\d')
+
+# Per-directory cache of ffprobe results, keyed by name, size and mtime
+PROBE_CACHE_NAME = '.ffprobe_cache.json'
+
+# FFmpeg prefix: errors only on stderr, machine-readable progress every
+# 2 seconds on stdout instead of a status line per frame batch
+FFMPEG_BASE_ARGS = ('ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-nostats',
+                    '-progress', 'pipe:1', '-stats_period', '2')
+
+# Output filename templates by naming choice: original name + suffix,
+# sequential numbering, or original name + batch start timestamp
+OUTPUT_NAME_TEMPLATES = {
+    '1': '{stem}_{codec}.mp4',
+    '2': '{index:03d}_{codec}.mp4',
+    '3': '{stem}_{timestamp}.mp4',
+}
+
+# Minimum seconds between progress line repaints (max 2 Hz)
+PROGRESS_INTERVAL = 0.5
+
+# The -progress keys the monitor loop cares about
+PROGRESS_PATTERN = re.compile(rb'^(out_time_us|speed|progress)=(.*)$', re.MULTILINE)
+
+# Serializes terminal output from concurrent encode workers
+_print_lock = threading.Lock()
+
+# FFmpeg processes currently running, so they can be killed on interrupt
+_active_processes = set()
+
+# Per worker thread state (the GPU the worker encodes on)
+_worker_state = threading.local()
+
+
 def print_header(text: str):
     """Print colored header"""
-    print(f"\n{Colors.HEADER}{Colors.BOLD}{'='*60}{Colors.END}")
-    print(f"{Colors.HEADER}{Colors.BOLD}{text.center(60)}{Colors.END}")
-    print(f"{Colors.HEADER}{Colors.BOLD}{'='*60}{Colors.END}\n")
+    with _print_lock:
+        sys.stdout.write(f"\n{_HEADER_RULE}\n{_HEADER_PREFIX}{text.center(60)}{Colors.END}\n{_HEADER_RULE}\n\n")
 
 
 def print_success(text: str):
     """Print success message"""
-    print(f"{Colors.GREEN}✓ {text}{Colors.END}")
+    with _print_lock:
+        sys.stdout.write(_SUCCESS_PREFIX + text + _END)
 
 
 def print_error(text: str):
     """Print error message"""
-    print(f"{Colors.RED}✗ {text}{Colors.END}")
+    with _print_lock:
+        sys.stdout.write(_ERROR_PREFIX + text + _END)
 
 
 def print_info(text: str):
     """Print info message"""
-    print(f"{Colors.CYAN}ℹ {text}{Colors.END}")
+    with _print_lock:
+        sys.stdout.write(_INFO_PREFIX + text + _END)
 
 
 def print_warning(text: str):
     """Print warning message"""
-    print(f"{Colors.YELLOW}⚠ {text}{Colors.END}")
+    with _print_lock:
+        sys.stdout.write(_WARNING_PREFIX + text + _END)
 
 
 def check_dependencies():
@@ -60,9 +137,8 @@ def check_dependencies():
     try:
         result = subprocess.run(['ffmpeg', '-version'], 
                               capture_output=True, 
-                              text=True, 
                               check=True)
-        if 'nvenc' not in result.stdout.lower():
+        if b'nvenc' not in result.stdout.lower():
             print_error("FFmpeg found but NVENC support not detected!")
             print_info("Make sure FFmpeg is compiled with --enable-nvenc")
             return False
@@ -84,53 +160,202 @@ def check_dependencies():
     return True
 
 
-def get_video_metadata(filepath: Path) -> Dict:
-    """Extract metadata from video file using ffprobe"""
+def query_gpus() -> List[Tuple[int, int, str]]:
+    """Query (index, open NVENC sessions, name) for every NVIDIA GPU"""
     try:
-        cmd = [
-            'ffprobe',
-            '-v', 'quiet',
-            '-print_format', 'json',
-            '-show_format',
-            '-show_streams',
-            str(filepath)
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        metadata = json.loads(result.stdout)
-        
-        # Get creation time from metadata or file stats
-        creation_time = None
-        if 'format' in metadata and 'tags' in metadata['format']:
-            tags = metadata['format']['tags']
-            # Try different tag names
-            for tag in ['creation_time', 'date', 'com.apple.quicktime.creationdate']:
-                if tag in tags:
-                    try:
-                        creation_time = datetime.fromisoformat(tags[tag].replace('Z', '+00:00'))
-                        break
-                    except:
-                        pass
-        
-        # Fallback to file modification time
-        if not creation_time:
-            creation_time = datetime.fromtimestamp(filepath.stat().st_mtime)
-        
-        # Get video duration
-        duration = float(metadata['format']['duration'])
+        result = subprocess.run(
+            ['nvidia-smi', '--query-gpu=index,encoder.stats.sessionCount,name',
+             '--format=csv,noheader,nounits'],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return []
+    
+    gpus = []
+    for line in result.stdout.splitlines():
+        fields = [field.strip() for field in line.split(',', 2)]
+        if len(fields) == 3 and fields[0].isdigit():
+            sessions = int(fields[1]) if fields[1].isdigit() else 0
+            gpus.append((int(fields[0]), sessions, fields[2]))
+    return gpus
+
+
+def nvenc_session_limit(name: str) -> Optional[int]:
+    """Maximum concurrent NVENC sessions for a GPU model (None if unlimited)"""
+    if 'GeForce' in name or 'TITAN' in name:
+        return CONSUMER_NVENC_SESSION_LIMIT
+    return None
+
+
+def plan_nvenc_workers(max_concurrent: int = None) -> List[int]:
+    """Plan the GPU for each encode worker without exceeding free NVENC sessions
+    
+    Returns one GPU index per worker, handed out round-robin across GPUs.
+    """
+    gpus = query_gpus()
+    if not gpus:
+        # nvidia-smi unavailable, nothing to check against
+        return [0] * (max_concurrent or DEFAULT_NVENC_SESSIONS)
+    
+    free = {}
+    for index, sessions, name in gpus:
+        limit = nvenc_session_limit(name)
+        free[index] = None if limit is None else max(0, limit - sessions)
+    
+    wanted = max_concurrent or DEFAULT_NVENC_SESSIONS * len(gpus)
+    workers = []
+    while len(workers) < wanted:
+        added = False
+        for index in free:
+            if len(workers) == wanted:
+                break
+            if free[index] is None or free[index] > 0:
+                workers.append(index)
+                if free[index] is not None:
+                    free[index] -= 1
+                added = True
+        if not added:
+            break
+    return workers
+
+
+@functools.lru_cache(maxsize=None)
+def has_legacy_nvenc_gpu() -> bool:
+    """Check (once) if any GPU is a Pascal or older NVENC generation"""
+    try:
+        result = subprocess.run(
+            ['nvidia-smi', '--query-gpu=name', '--format=csv,noheader'],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        return any(LEGACY_NVENC_GPU_PATTERN.search(name) for name in result.stdout.splitlines())
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+
+
+def gop_args(video: Dict, choices: Dict) -> List[str]:
+    """Per-file NVENC GOP size: two seconds of output frames"""
+    if not choices['use_nvenc']:
+        return []
+    fps_out = float(choices['fps']) if choices['fps'] else video['fps']
+    return ['-g', str(round(fps_out * 2))]
+
+
+def assign_worker_gpu(gpu_cycle: itertools.cycle, lock: threading.Lock):
+    """Thread pool initializer giving each worker the next GPU, round-robin"""
+    with lock:
+        _worker_state.gpu = next(gpu_cycle)
+
+
+def kill_active_processes():
+    """Kill all running FFmpeg processes"""
+    with _print_lock:
+        processes = list(_active_processes)
+    for process in processes:
+        process.kill()
+
+
+def load_probe_cache(directory: Path) -> Dict:
+    """Load cached ffprobe results for a directory"""
+    try:
+        with open(directory / PROBE_CACHE_NAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_probe_cache(directory: Path, cache: Dict):
+    """Atomically write cached ffprobe results for a directory"""
+    cache_path = directory / PROBE_CACHE_NAME
+    tmp_path = cache_path.with_suffix('.tmp')
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Read-only media etc. - caching is best effort
+        pass
+
+
+def parse_frame_rate(rate: str) -> float:
+    """Parse an ffprobe frame rate such as '60000/1001'"""
+    num, _, den = rate.partition('/')
+    return int(num) / int(den) if den else float(num)
+
+
+def get_video_metadata(filepath: Path, cache: Dict = None, st: os.stat_result = None) -> Dict:
+    """Extract metadata from video file using ffprobe (or the probe cache)"""
+    try:
+        if st is None:
+            st = filepath.stat()
+        key = f"{filepath.name}:{st.st_size}:{int(st.st_mtime)}"
         
-        # Get video stream info
-        video_stream = next((s for s in metadata['streams'] if s['codec_type'] == 'video'), None)
+        if cache is not None and key in cache:
+            info = cache[key]
+        else:
+            # Only ask for the first video stream and the fields we use
+            cmd = [
+                'ffprobe',
+                '-v', 'error',
+                '-select_streams', 'v:0',
+                '-show_entries', 'stream=width,height,codec_name,r_frame_rate'
+                                 ':format=duration'
+                                 ':format_tags=creation_time,date,com.apple.quicktime.creationdate',
+                '-of', 'json',
+                str(filepath)
+            ]
+            
+            # json.loads takes the raw bytes, no need to decode them first
+            result = subprocess.run(cmd, capture_output=True, check=True)
+            metadata = json.loads(result.stdout)
+            
+            # Get creation time from metadata or file stats
+            creation_time = None
+            if 'format' in metadata and 'tags' in metadata['format']:
+                tags = metadata['format']['tags']
+                # Try different tag names
+                for tag in ['creation_time', 'date', 'com.apple.quicktime.creationdate']:
+                    if tag in tags:
+                        try:
+                            creation_time = datetime.fromisoformat(tags[tag].replace('Z', '+00:00'))
+                            break
+                        except:
+                            pass
+            
+            # Fallback to file modification time
+            if not creation_time:
+                creation_time = datetime.fromtimestamp(st.st_mtime)
+            
+            # Get video duration
+            duration = float(metadata['format']['duration'])
+            
+            # Get video stream info
+            video_stream = next(iter(metadata.get('streams', [])), None)
+            
+            # Only keep what is actually used, so the cache stays small
+            info = {
+                'creation_time': creation_time.isoformat(),
+                'duration': duration,
+                'width': video_stream.get('width', 0) if video_stream else 0,
+                'height': video_stream.get('height', 0) if video_stream else 0,
+                'codec': video_stream.get('codec_name', 'unknown') if video_stream else 'unknown',
+                'fps': parse_frame_rate(video_stream.get('r_frame_rate', '30/1')) if video_stream else 30
+            }
+            if cache is not None:
+                cache[key] = info
         
         return {
             'filepath': filepath,
-            'creation_time': creation_time,
-            'duration': duration,
-            'width': video_stream.get('width', 0) if video_stream else 0,
-            'height': video_stream.get('height', 0) if video_stream else 0,
-            'codec': video_stream.get('codec_name', 'unknown') if video_stream else 'unknown',
-            'fps': eval(video_stream.get('r_frame_rate', '30/1')) if video_stream else 30,
-            'size': filepath.stat().st_size
+            'creation_time': datetime.fromisoformat(info['creation_time']),
+            'duration': info['duration'],
+            'width': info['width'],
+            'height': info['height'],
+            'codec': info['codec'],
+            'fps': info['fps'],
+            'size': st.st_size
         }
     except Exception as e:
         print_error(f"Error reading metadata from {filepath.name}: {e}")
@@ -141,18 +366,36 @@ def find_gopro_videos(directory: Path) -> List[Dict]:
     """Find all GoPro video files and sort by creation time"""
     print_info(f"Scanning directory: {directory}")
     
-    video_files = []
     extensions = {'.mp4', '.MP4'}
+    cache = load_probe_cache(directory)
     
+    # Stat each candidate once; size and mtime are reused by the probe
+    candidates = []
     for filepath in directory.iterdir():
-        if filepath.is_file() and filepath.suffix in extensions:
-            metadata = get_video_metadata(filepath)
-            if metadata:
-                video_files.append(metadata)
-                size_mb = metadata['size'] / (1024 * 1024)
-                print(f"  Found: {filepath.name:30s} | "
-                      f"{metadata['creation_time'].strftime('%Y-%m-%d %H:%M:%S')} | "
-                      f"{size_mb:7.1f} MB")
+        if filepath.suffix in extensions:
+            try:
+                st = filepath.stat()
+            except OSError:
+                # Broken symlink or file removed while scanning
+                continue
+            if stat.S_ISREG(st.st_mode):
+                candidates.append((filepath, st))
+    
+    # ffprobe calls are I/O bound, so probe files concurrently
+    with ThreadPoolExecutor(max_workers=min(16, (os.cpu_count() or 1) * 2)) as executor:
+        results = executor.map(lambda candidate: get_video_metadata(candidate[0], cache, candidate[1]),
+                               candidates)
+        video_files = [metadata for metadata in results if metadata]
+    
+    for metadata in video_files:
+        size_mb = metadata['size'] / (1024 * 1024)
+        print(f"  Found: {metadata['filepath'].name:30s} | "
+              f"{metadata['creation_time'].strftime('%Y-%m-%d %H:%M:%S')} | "
+              f"{size_mb:7.1f} MB")
+    
+    # Drop entries for files that are no longer present
+    names = {v['filepath'].name for v in video_files}
+    save_probe_cache(directory, {k: v for k, v in cache.items() if k.rsplit(':', 2)[0] in names})
     
     # Sort by creation time
     video_files.sort(key=lambda x: x['creation_time'])
@@ -168,13 +411,14 @@ def format_duration(seconds: float) -> str:
     return f"{hours:02d}:{minutes:02d}:{secs:02d}"
 
 
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
+
 def format_size(bytes_size: int) -> str:
     """Format file size in human-readable format"""
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if bytes_size < 1024.0:
-            return f"{bytes_size:.2f} {unit}"
-        bytes_size /= 1024.0
-    return f"{bytes_size:.2f} PB"
+    # Each unit is 2**10 times the previous one, so the bit length picks it
+    idx = min(max(0, (int(bytes_size).bit_length() - 1) // 10), len(SIZE_UNITS) - 1)
+    return f"{bytes_size / (1 << (idx * 10)):.2f} {SIZE_UNITS[idx]}"
 
 
 def get_user_choices() -> Dict:
@@ -252,6 +496,16 @@ def get_user_choices() -> Dict:
     else:
         choices['preset'] = 'medium'
     
+    # Encoding backend (only offered when PyNvVideoCodec is installed)
+    choices['backend'] = 'ffmpeg'
+    if choices['use_nvenc'] and nvc is not None:
+        print(f"\n{Colors.BOLD}Encoding backend:{Colors.END}")
+        print("  1. FFmpeg")
+        print("  2. PyNvVideoCodec (frames stay on the GPU, no filters)")
+        backend_choice = input(f"{Colors.CYAN}Select [1-2] (default: 1): {Colors.END}").strip() or "1"
+        if backend_choice == "2":
+            choices['backend'] = 'pynvc'
+    
     # Bitrate
     print(f"\n{Colors.BOLD}Bitrate (Mbps):{Colors.END}")
     bitrate = input(f"{Colors.CYAN}Enter bitrate in Mbps (default: 50): {Colors.END}").strip() or "50"
@@ -268,43 +522,215 @@ def get_user_choices() -> Dict:
     return choices
 
 
-def generate_output_filename(video: Dict, choices: Dict, index: int, codec_name: str) -> str:
-    """Generate output filename based on user choice"""
-    stem = video['filepath'].stem
-    
-    if choices['naming'] == '1':
-        # Original name + suffix
-        return f"{stem}_{codec_name}.mp4"
-    elif choices['naming'] == '2':
-        # Sequential numbering
-        return f"{index:03d}_{codec_name}.mp4"
-    else:  # '3'
-        # Add timestamp
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        return f"{stem}_{timestamp}.mp4"
+def build_name_template(choices: Dict, codec_name: str, timestamp: str) -> str:
+    """Pick the output filename template once per batch"""
+    template = OUTPUT_NAME_TEMPLATES.get(choices['naming'], OUTPUT_NAME_TEMPLATES['3'])
+    return template.replace('{codec}', codec_name).replace('{timestamp}', timestamp)
 
 
-def encode_video(video: Dict, output_file: Path, choices: Dict, index: int, total: int) -> bool:
-    """Encode a single video file"""
+def generate_output_filename(video: Dict, name_template: str, index: int) -> str:
+    """Generate output filename from the batch's filename template"""
+    return name_template.format(stem=video['filepath'].stem, index=index)
+
+
+def pynvc_supported(choices: Dict) -> bool:
+    """Check if the PyNvVideoCodec backend can handle the chosen options"""
+    return (choices['backend'] == 'pynvc'
+            and choices['codec'] in PYNVC_CODECS
+            and not choices['resolution']
+            and not choices['fps']
+            and not choices['stabilization'])
+
+
+def encode_video_pynvc(video: Dict, output_file: Path, choices: Dict, index: int, total: int,
+                       gpu: int = 0) -> Optional[bool]:
+    """Encode a single video file with PyNvVideoCodec, using FFmpeg only for audio and muxing
     
-    print_header(f"ENCODING {index}/{total}: {video['filepath'].name}")
+    Returns None if the decoded frames are not NV12 (e.g. 10-bit HEVC), so the
+    caller can encode the file with FFmpeg instead.
+    """
+    codec = PYNVC_CODECS[choices['codec']]
+    bitrate = int(choices['bitrate'][:-1]) * 1000000
+    video_stream = output_file.with_suffix(f'.{codec}')
+    audio_stream = output_file.with_suffix('.m4a')
     
-    # Build FFmpeg command
-    cmd = ['ffmpeg', '-y']
+    start_time = datetime.now()
     
-    # Input
-    cmd.extend(['-i', str(video['filepath'])])
+    # Extract audio in parallel with the GPU encode
+    audio_process = subprocess.Popen(
+        ['ffmpeg', '-y', '-v', 'error', '-i', str(video['filepath']),
+         '-vn', '-c:a', 'copy', str(audio_stream)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    
+    try:
+        # Decoder and encoder share the GPU's primary CUDA context,
+        # so it is set up once per process rather than once per file
+        demuxer = nvc.CreateDemuxer(filename=str(video['filepath']))
+        decoder = nvc.CreateDecoder(gpuid=gpu, codec=demuxer.GetNvCodecId(),
+                                    cudacontext=0, cudastream=0,
+                                    usedevicememory=True)
+        
+        # The encoder is created at the first frame, once the decoder's
+        # output format is known
+        encoder = None
+        frame_count = 0
+        with open(video_stream, 'wb') as f:
+            for packet in demuxer:
+                for frame in decoder.Decode(packet):
+                    if encoder is None:
+                        if decoder.GetPixelFormat() != nvc.Pixel_Format.NV12:
+                            print_warning("Decoded frames are not NV12 (10-bit source?), using FFmpeg")
+                            return None
+                        # Rate control needs the real frame rate to hit the bitrate
+                        encoder = nvc.CreateEncoder(video['width'], video['height'], 'NV12', False,
+                                                    gpuid=gpu,
+                                                    codec=codec,
+                                                    preset=choices['preset'].upper(),
+                                                    fps=round(video['fps']),
+                                                    rc='vbr',
+                                                    bitrate=bitrate,
+                                                    maxbitrate=bitrate,
+                                                    vbvbufsize=bitrate * 2)
+                    f.write(bytearray(encoder.Encode(frame)))
+                    frame_count += 1
+                    if frame_count % 100 == 0:
+                        with _print_lock:
+                            print(f"\r{Colors.CYAN}[{index}/{total}] frame={frame_count}{Colors.END}",
+                                  end='', flush=True)
+            if encoder is not None:
+                f.write(bytearray(encoder.EndEncode()))
+        with _print_lock:
+            print()  # New line after progress
+        
+        # Mux the raw video stream with the original audio
+        audio_process.wait()
+        cmd = ['ffmpeg', '-y', '-v', 'error',
+               '-r', str(video['fps']), '-i', str(video_stream)]
+        if audio_process.returncode == 0:
+            cmd.extend(['-i', str(audio_stream), '-map', '0:v', '-map', '1:a'])
+        cmd.extend(['-c', 'copy', str(output_file)])
+        subprocess.run(cmd, capture_output=True, check=True)
+        
+        elapsed = (datetime.now() - start_time).total_seconds()
+        output_size = output_file.stat().st_size
+        compression_ratio = (1 - output_size / video['size']) * 100
+        
+        print_success(f"Encoded successfully in {format_duration(elapsed)}")
+        print_info(f"Output size: {format_size(output_size)} ({compression_ratio:+.1f}%)")
+        
+        return True
+    except subprocess.CalledProcessError:
+        print_error("FFmpeg muxing failed!")
+        return False
+    except Exception as e:
+        print_error(f"Error during encoding: {e}")
+        return False
+    finally:
+        audio_process.kill()
+        audio_process.wait()
+        for temp_file in (video_stream, audio_stream):
+            if temp_file.exists():
+                temp_file.unlink()
+
+
+def run_ffmpeg(cmd: List[str], duration: float, label: str) -> bool:
+    """Run FFmpeg, showing its progress, and report whether it succeeded"""
+    # stderr is kept for reporting failures
+    error_log = tempfile.TemporaryFile()
+    process = None
+    try:
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=error_log
+        )
+        with _print_lock:
+            _active_processes.add(process)
+        
+        # Monitor progress (key=value pairs from -progress, parsed as bytes)
+        out_time = 0.0
+        speed = b'N/A'
+        last_paint = 0.0
+        pending = b''
+        while True:
+            chunk = process.stdout.read1(4096)
+            if not chunk:
+                break
+            complete, _, pending = (pending + chunk).rpartition(b'\n')
+            for key, value in PROGRESS_PATTERN.findall(complete):
+                if key == b'out_time_us':
+                    if value.isdigit():
+                        out_time = int(value) / 1000000
+                elif key == b'speed':
+                    speed = value
+                else:
+                    # End of a progress block - repaint, throttled
+                    now = time.monotonic()
+                    if now - last_paint < PROGRESS_INTERVAL and value != b'end':
+                        continue
+                    last_paint = now
+                    percent = out_time / duration * 100 if duration else 0
+                    with _print_lock:
+                        print(f"\r{Colors.CYAN}[{label}] time={format_duration(out_time)} "
+                              f"({percent:5.1f}%) speed={speed.decode().strip()}{Colors.END}",
+                              end='', flush=True)
+        
+        process.wait()
+        with _print_lock:
+            print()  # New line after progress
+        
+        if process.returncode != 0:
+            print_error("FFmpeg encoding failed!")
+            error_log.seek(0)
+            with _print_lock:
+                for line in error_log.read().decode(errors='replace').splitlines()[-5:]:
+                    print(f"  {line}")
+            return False
+        
+        return True
+    except KeyboardInterrupt:
+        if process:
+            process.kill()
+        raise
+    finally:
+        if process:
+            with _print_lock:
+                _active_processes.discard(process)
+        error_log.close()
+
+
+def build_ffmpeg_args(choices: Dict, transforms: Path = None) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """Build the input-side and output-side FFmpeg arguments shared by every file
+    
+    With stabilization enabled, transforms is the vidstabdetect result for the file.
+    """
+    input_args = []
+    output_args = []
+    
+    # Decode on the GPU and keep frames in GPU memory through to NVENC,
+    # unless a CPU-only filter (vidstab) is needed
+    gpu_pipeline = choices['use_nvenc'] and not choices['stabilization']
+    if gpu_pipeline:
+        input_args.extend(['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda', '-extra_hw_frames', '8'])
+    elif choices['use_nvenc']:
+        # Still decode on the GPU, frames are downloaded for the CPU filters
+        input_args.extend(['-hwaccel', 'cuda'])
     
     # Video filters
     vfilters = []
     
     # Stabilization (if requested)
     if choices['stabilization']:
-        vfilters.append('vidstabtransform=smoothing=30:zoom=5')
+        vfilters.append(f'vidstabtransform=input={transforms}:smoothing=30:zoom=5')
     
     # Resolution
     if choices['resolution']:
-        vfilters.append(f"scale={choices['resolution']}:flags=lanczos")
+        if gpu_pipeline:
+            vfilters.append(f"scale_cuda={choices['resolution']}")
+        else:
+            vfilters.append(f"scale={choices['resolution']}:flags=lanczos")
     
     # Frame rate
     if choices['fps']:
@@ -312,39 +738,67 @@ def encode_video(video: Dict, output_file: Path, choices: Dict, index: int, tota
     
     # Apply filters
     if vfilters:
-        cmd.extend(['-vf', ','.join(vfilters)])
+        output_args.extend(['-vf', ','.join(vfilters)])
     
     # Video encoding
-    cmd.extend(['-c:v', choices['codec']])
+    output_args.extend(['-c:v', choices['codec']])
     
     if choices['use_nvenc']:
         # NVENC specific settings
-        cmd.extend([
+        bitrate_mbps = int(choices['bitrate'][:-1])
+        output_args.extend([
             '-preset', choices['preset'],
             '-b:v', choices['bitrate'],
             '-maxrate', choices['bitrate'],
-            '-bufsize', f"{int(choices['bitrate'][:-1]) * 2}M",
+            '-bufsize', f"{bitrate_mbps * 2}M",
             '-rc', 'vbr',
             '-rc-lookahead', '32',
             '-spatial-aq', '1',
             '-temporal-aq', '1',
         ])
         
+        if not has_legacy_nvenc_gpu():
+            output_args.extend(['-bf', '2', '-b_ref_mode', 'middle', '-refs', '1'])
+        
         if 'hevc' in choices['codec']:
-            cmd.extend(['-tier', 'high'])
+            output_args.extend(['-tier', 'high'])
     else:
         # CPU encoding settings
-        cmd.extend([
+        output_args.extend([
             '-preset', choices['preset'],
             '-crf', '23',
             '-b:v', choices['bitrate'],
         ])
     
     # Audio encoding
-    cmd.extend(['-c:a', 'aac', '-b:a', '192k'])
+    output_args.extend(['-c:a', 'aac', '-b:a', '192k'])
     
-    # Output
-    cmd.append(str(output_file))
+    return tuple(input_args), tuple(output_args)
+
+
+def detect_camera_motion(video: Dict, transforms: Path, choices: Dict, label: str,
+                         gpu: int = 0) -> bool:
+    """Run the vidstabdetect pass, writing camera motion to a transforms file"""
+    cmd = list(FFMPEG_BASE_ARGS)
+    if choices['use_nvenc']:
+        # Decode on the GPU, frames are downloaded for the CPU-only filter
+        cmd.extend(['-hwaccel', 'cuda', '-hwaccel_device', str(gpu)])
+    cmd.extend([
+        '-i', str(video['filepath']),
+        '-vf', f'vidstabdetect=shakiness=5:result={transforms}',
+        '-f', 'null', '-'
+    ])
+    return run_ffmpeg(cmd, video['duration'], label)
+
+
+def encode_video(video: Dict, output_file: Path, choices: Dict, index: int, total: int,
+                 ffmpeg_args: Tuple[Tuple[str, ...], Tuple[str, ...]] = None) -> bool:
+    """Encode a single video file"""
+    
+    print_header(f"ENCODING {index}/{total}: {video['filepath'].name}")
+    
+    # GPU assigned to this worker thread by the pool initializer
+    gpu = getattr(_worker_state, 'gpu', 0)
     
     print_info(f"Input:  {video['filepath'].name}")
     print_info(f"Output: {output_file.name}")
@@ -352,62 +806,146 @@ def encode_video(video: Dict, output_file: Path, choices: Dict, index: int, tota
     print_info(f"Duration: {format_duration(video['duration'])}")
     print()
     
+    if pynvc_supported(choices):
+        result = encode_video_pynvc(video, output_file, choices, index, total, gpu)
+        if result is not None:
+            return result
+    
     # Execute FFmpeg
+    transforms = None
     try:
         start_time = datetime.now()
         
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1
-        )
+        if choices['stabilization']:
+            # Pass 1: analyze camera shake into a transforms file
+            fd, transforms = tempfile.mkstemp(suffix='.trf')
+            os.close(fd)
+            transforms = Path(transforms)
+            print_info("Stabilization pass 1/2: detecting camera motion")
+            if not detect_camera_motion(video, transforms, choices, f"{index}/{total}", gpu):
+                return False
+            print_info("Stabilization pass 2/2: encoding")
+            ffmpeg_args = build_ffmpeg_args(choices, transforms)
         
-        # Monitor progress
-        last_line = ""
-        for line in process.stdout:
-            if 'frame=' in line or 'time=' in line:
-                # Extract speed if available
-                if 'speed=' in line:
-                    print(f"\r{Colors.CYAN}{line.strip()}{Colors.END}", end='', flush=True)
-                    last_line = line.strip()
+        input_args, output_args = ffmpeg_args or build_ffmpeg_args(choices)
         
-        process.wait()
-        print()  # New line after progress
+        # Pin decode and encode to this worker's GPU
+        gpu_input_args = []
+        gpu_output_args = []
+        if choices['use_nvenc']:
+            gpu_input_args = ['-hwaccel_device', str(gpu)]
+            gpu_output_args = ['-gpu', str(gpu)]
         
-        if process.returncode == 0:
-            end_time = datetime.now()
-            elapsed = (end_time - start_time).total_seconds()
-            
-            # Get output file size
-            output_size = output_file.stat().st_size
-            compression_ratio = (1 - output_size / video['size']) * 100
-            
-            print_success(f"Encoded successfully in {format_duration(elapsed)}")
-            print_info(f"Output size: {format_size(output_size)} ({compression_ratio:+.1f}%)")
-            
-            return True
-        else:
-            print_error("FFmpeg encoding failed!")
+        cmd = [*FFMPEG_BASE_ARGS,
+               *input_args, *gpu_input_args, '-i', str(video['filepath']),
+               *output_args, *gop_args(video, choices), *gpu_output_args, str(output_file)]
+        
+        if not run_ffmpeg(cmd, video['duration'], f"{index}/{total}"):
             return False
+        
+        end_time = datetime.now()
+        elapsed = (end_time - start_time).total_seconds()
+        
+        # Get output file size
+        output_size = output_file.stat().st_size
+        compression_ratio = (1 - output_size / video['size']) * 100
+        
+        print_success(f"Encoded successfully in {format_duration(elapsed)}")
+        print_info(f"Output size: {format_size(output_size)} ({compression_ratio:+.1f}%)")
+        
+        return True
             
     except KeyboardInterrupt:
         print_error("\nEncoding interrupted by user!")
-        process.kill()
         raise
     except Exception as e:
         print_error(f"Error during encoding: {e}")
         return False
+    finally:
+        if transforms and transforms.exists():
+            transforms.unlink()
+
+
+def can_encode_in_one_process(video_files: List[Dict], choices: Dict, max_workers: int) -> bool:
+    """Check if a serial NVENC batch can be encoded by a single FFmpeg process"""
+    formats = {(v['width'], v['height'], v['fps'], v['codec']) for v in video_files}
+    return (max_workers == 1
+            and choices['use_nvenc']
+            and not choices['stabilization']
+            and not pynvc_supported(choices)
+            and len(video_files) > 1
+            and len(formats) == 1)
+
+
+def encode_videos_in_one_process(jobs: List[Tuple[int, Dict, Path]], output_dir: Path, choices: Dict,
+                                 ffmpeg_args: Tuple[Tuple[str, ...], Tuple[str, ...]],
+                                 gpu: int = 0) -> bool:
+    """Encode all jobs with one FFmpeg process (concat input, segmented output)
+    
+    CUDA and the NVENC session are initialized once for the whole batch
+    instead of once per file.
+    """
+    concat_file = output_dir / '.concat_list.txt'
+    
+    with open(concat_file, 'w') as f:
+        for _, video, _ in jobs:
+            filepath = str(video['filepath'].absolute()).replace("'", "'\\''")
+            f.write(f"file '{filepath}'\n")
+    
+    # Split the output at every input boundary, forcing a keyframe there
+    boundaries = []
+    elapsed = 0.0
+    for _, video, _ in jobs[:-1]:
+        elapsed += video['duration']
+        boundaries.append(f"{elapsed:.3f}")
+    segment_times = ','.join(boundaries)
+    
+    input_args, output_args = ffmpeg_args
+    
+    # Pin decode and encode to the GPU the session plan picked
+    cmd = [*FFMPEG_BASE_ARGS,
+           *input_args, '-hwaccel_device', str(gpu),
+           '-f', 'concat', '-safe', '0', '-i', str(concat_file),
+           *output_args, *gop_args(jobs[0][1], choices), '-gpu', str(gpu),
+           '-force_key_frames', segment_times,
+           '-f', 'segment',
+           '-segment_times', segment_times,
+           '-segment_format', 'mp4',
+           '-reset_timestamps', '1',
+           str(output_dir / '.segment_%03d.mp4')]
+    
+    total_duration = sum(video['duration'] for _, video, _ in jobs)
+    
+    try:
+        if not run_ffmpeg(cmd, total_duration, f"1-{len(jobs)}/{len(jobs)}"):
+            return False
+        for number, (_, _, output_file) in enumerate(jobs):
+            os.replace(output_dir / f'.segment_{number:03d}.mp4', output_file)
+        return True
+    except OSError as e:
+        print_error(f"Error splitting encoded output: {e}")
+        return False
+    finally:
+        if concat_file.exists():
+            concat_file.unlink()
+        for segment in output_dir.glob('.segment_*.mp4'):
+            segment.unlink()
 
 
-def batch_encode_videos(video_files: List[Dict], output_dir: Path, choices: Dict):
-    """Batch encode all videos"""
+def batch_encode_videos(video_files: List[Dict], output_dir: Path, choices: Dict,
+                        max_concurrent: int = None) -> bool:
+    """Batch encode all videos, running several encodes concurrently
+    
+    Returns False if the batch could not be started.
+    """
     
     # Create output directory
     output_dir.mkdir(exist_ok=True)
     
+    # Computed once, so timestamp naming gives every file the same batch id
     codec_name = choices['codec'].replace('_nvenc', '').replace('lib', '')
+    batch_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    name_template = build_name_template(choices, codec_name, batch_timestamp)
     
     print_header("STARTING BATCH ENCODE")
     print_info(f"Output directory: {output_dir}")
@@ -418,6 +956,24 @@ def batch_encode_videos(video_files: List[Dict], output_dir: Path, choices: Dict
     
     print_info(f"Total input size: {format_size(total_input_size)}")
     print_info(f"Total duration: {format_duration(total_duration)}")
+    
+    if choices['use_nvenc']:
+        # Never open more NVENC sessions than the GPUs allow
+        worker_gpus = plan_nvenc_workers(max_concurrent)
+        if not worker_gpus:
+            print_error("No free NVENC sessions! Close other encoding applications and retry.")
+            return False
+        if max_concurrent and len(worker_gpus) < max_concurrent:
+            print_warning(f"Limiting concurrent encodes to {len(worker_gpus)} (free NVENC sessions)")
+        if len(set(worker_gpus)) > 1:
+            print_info(f"GPUs: {', '.join(str(gpu) for gpu in sorted(set(worker_gpus)))}")
+        max_workers = len(worker_gpus)
+    else:
+        worker_gpus = [0]
+        max_workers = max_concurrent or max(1, (os.cpu_count() or 1) // 4)
+    print_info(f"Concurrent encodes: {max_workers}")
+    if choices['backend'] == 'pynvc' and not pynvc_supported(choices):
+        print_warning("PyNvVideoCodec backend does not support the selected codec/filters, using FFmpeg")
     print()
     
     # Track statistics
@@ -428,26 +984,67 @@ def batch_encode_videos(video_files: List[Dict], output_dir: Path, choices: Dict
     
     failed_files = []
     
-    # Process each video
+    # Arguments shared by every job are built once (stabilized jobs
+    # build their own, as they depend on the per-file transforms)
+    ffmpeg_args = None if choices['stabilization'] else build_ffmpeg_args(choices)
+    
+    # Build the job queue, then dispatch it to a bounded worker pool
+    jobs = []
     for index, video in enumerate(video_files, 1):
-        output_filename = generate_output_filename(video, choices, index, codec_name)
-        output_file = output_dir / output_filename
-        
+        output_filename = generate_output_filename(video, name_template, index)
+        jobs.append((index, video, output_dir / output_filename))
+    
+    if can_encode_in_one_process(video_files, choices, max_workers):
+        print_header(f"ENCODING {len(jobs)} FILES IN ONE PASS")
         try:
-            if encode_video(video, output_file, choices, index, len(video_files)):
-                success_count += 1
-                if output_file.exists():
-                    total_output_size += output_file.stat().st_size
+            if encode_videos_in_one_process(jobs, output_dir, choices, ffmpeg_args, worker_gpus[0]):
+                success_count = len(jobs)
+                total_output_size = sum(output_file.stat().st_size for _, _, output_file in jobs)
             else:
-                failed_count += 1
-                failed_files.append(video['filepath'].name)
+                failed_count = len(jobs)
+                failed_files = [video['filepath'].name for _, video, _ in jobs]
         except KeyboardInterrupt:
             print_warning("\nBatch encoding interrupted by user!")
-            break
         except Exception as e:
             print_error(f"Unexpected error: {e}")
-            failed_count += 1
-            failed_files.append(video['filepath'].name)
+            failed_count = len(jobs)
+            failed_files = [video['filepath'].name for _, video, _ in jobs]
+    else:
+        # Each worker thread is pinned to one GPU, handed out round-robin
+        executor = ThreadPoolExecutor(max_workers=max_workers,
+                                      initializer=assign_worker_gpu,
+                                      initargs=(itertools.cycle(worker_gpus), threading.Lock()))
+        futures = {
+            executor.submit(encode_video, video, output_file, choices, index, len(video_files),
+                            ffmpeg_args): (video, output_file)
+            for index, video, output_file in jobs
+        }
+        
+        try:
+            for future in as_completed(futures):
+                video, output_file = futures[future]
+                try:
+                    if future.result():
+                        success_count += 1
+                        try:
+                            total_output_size += output_file.stat().st_size
+                        except FileNotFoundError:
+                            pass
+                    else:
+                        failed_count += 1
+                        failed_files.append(video['filepath'].name)
+                except Exception as e:
+                    print_error(f"Unexpected error: {e}")
+                    failed_count += 1
+                    failed_files.append(video['filepath'].name)
+        except KeyboardInterrupt:
+            print_warning("\nBatch encoding interrupted by user!")
+            # Drop queued encodes (shutdown's cancel_futures needs Python 3.9)
+            for future in futures:
+                future.cancel()
+            kill_active_processes()
+        finally:
+            executor.shutdown(wait=True)
     
     # Final summary
     end_time = datetime.now()
@@ -473,10 +1070,25 @@ def batch_encode_videos(video_files: List[Dict], output_dir: Path, choices: Dict
         if total_duration > 0:
             speed_factor = total_duration / total_elapsed
             print_info(f"Average speed: {speed_factor:.2f}x realtime")
+    
+    return True
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="GoPro Batch Encoder with NVENC")
+    parser.add_argument('directory', nargs='?',
+                        help="Input directory (prompted if omitted)")
+    parser.add_argument('--max-concurrent', type=int, default=None,
+                        help="Number of simultaneous encodes "
+                             "(default: 2 per GPU within free NVENC sessions, or CPU count / 4)")
+    return parser.parse_args()
 
 
 def main():
     """Main function"""
+    args = parse_args()
+    
     print_header("GoPro Batch Encoder with NVENC")
     
     # Check dependencies
@@ -484,8 +1096,8 @@ def main():
         sys.exit(1)
     
     # Get input directory
-    if len(sys.argv) > 1:
-        input_dir = Path(sys.argv[1])
+    if args.directory:
+        input_dir = Path(args.directory)
     else:
         input_path = input(f"{Colors.CYAN}Enter input directory (default: current): {Colors.END}").strip()
         input_dir = Path(input_path) if input_path else Path.cwd()
@@ -538,7 +1150,8 @@ def main():
     
     # Batch encode videos
     try:
-        batch_encode_videos(video_files, output_dir, choices)
+        if not batch_encode_videos(video_files, output_dir, choices, args.max_concurrent):
+            sys.exit(1)
         print_header("DONE!")
         print_success(f"All videos processed!")
         print_info(f"Output location: {output_dir}")
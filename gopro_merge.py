@@ -4,13 +4,66 @@ GoPro Video Merger with NVENC Hardware Acceleration
 Merges GoPro footage in chronological order using NVIDIA GPU encoding
 """
 
+import asyncio
 import os
+import re
 import sys
 import subprocess
 import json
+import tempfile
+import time
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# ffprobe results cache, keyed by resolved path, mtime and size
+METADATA_CACHE = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'gopro_merge' / 'metadata.json'
+
+# Concat list input; timestamps missing at clip joins are regenerated
+# rather than stalling the muxer
+CONCAT_INPUT_ARGS = ('-fflags', '+genpts', '-f', 'concat', '-safe', '0')
+
+# Maximum number of ffprobe processes running at once while scanning
+MAX_CONCURRENT_PROBES = 32
+
+# Minimum seconds between progress repaints
+PROGRESS_INTERVAL = 0.25
+
+# Pipe buffer requested for FFmpeg's progress output (Python 3.10+)
+PROGRESS_PIPE_SIZE = 1 << 20
+
+# The -progress keys shown in the progress line
+PROGRESS_PATTERN = re.compile(rb'^(frame|fps|out_time_us|speed|progress)=(.*)$', re.MULTILINE)
+
+# NVENC presets that get lookahead and adaptive quantization
+NVENC_HQ_PRESETS = {'p4', 'p7'}
+
+# Constant quality level used by the p7 (best quality) preset
+NVENC_P7_CQ = 19
+
+# Common creation time tag formats, tried before fromisoformat; %z also
+# accepts a trailing Z, which fromisoformat only does from Python 3.11
+# (e.g. 2023-10-12T14:30:00.000000Z, 2023-10-12T14:30:00+0200)
+ISO_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z')
+
+# GoPro camera file names: GH/GX/GP + chapter + clip number, or GOPR + clip
+# number for the first chapter on older cameras (e.g. GH011595.MP4)
+GOPRO_NAME_PATTERN = re.compile(r'^(G[HXP]|GOPR)(\d{2})?(\d{4})\.MP4$', re.IGNORECASE)
+
+# Bitstream format produced by each selectable encoder
+CODEC_FORMATS = {
+    'h264_nvenc': 'h264',
+    'hevc_nvenc': 'hevc',
+    'av1_nvenc': 'av1',
+    'libx264': 'h264',
+    'libx265': 'hevc',
+}
 
 
 class Colors:
@@ -25,26 +78,40 @@ class Colors:
     BOLD = '\033[1m'
 
 
+# Color codes are only useful on a terminal (and honor https://no-color.org)
+_USE_COLOR = sys.stdout.isatty() and os.environ.get('NO_COLOR') is None
+if not _USE_COLOR:
+    for _name in ('HEADER', 'BLUE', 'CYAN', 'GREEN', 'YELLOW', 'RED', 'END', 'BOLD'):
+        setattr(Colors, _name, '')
+
+# Message prefixes, built once instead of on every print
+_HEADER_RULE = f"{Colors.HEADER}{Colors.BOLD}{'='*60}{Colors.END}"
+_HEADER_PREFIX = f"{Colors.HEADER}{Colors.BOLD}"
+_SUCCESS_PREFIX = f"{Colors.GREEN}✓ "
+_ERROR_PREFIX = f"{Colors.RED}✗ "
+_INFO_PREFIX = f"{Colors.CYAN}ℹ "
+_PROGRESS_PREFIX = f"\r{Colors.CYAN}"
+_END = f"{Colors.END}\n"
+
+
 def print_header(text: str):
     """Print colored header"""
-    print(f"\n{Colors.HEADER}{Colors.BOLD}{'='*60}{Colors.END}")
-    print(f"{Colors.HEADER}{Colors.BOLD}{text.center(60)}{Colors.END}")
-    print(f"{Colors.HEADER}{Colors.BOLD}{'='*60}{Colors.END}\n")
+    sys.stdout.write(f"\n{_HEADER_RULE}\n{_HEADER_PREFIX}{text.center(60)}{Colors.END}\n{_HEADER_RULE}\n\n")
 
 
 def print_success(text: str):
     """Print success message"""
-    print(f"{Colors.GREEN}✓ {text}{Colors.END}")
+    sys.stdout.write(_SUCCESS_PREFIX + text + _END)
 
 
 def print_error(text: str):
     """Print error message"""
-    print(f"{Colors.RED}✗ {text}{Colors.END}")
+    sys.stdout.write(_ERROR_PREFIX + text + _END)
 
 
 def print_info(text: str):
     """Print info message"""
-    print(f"{Colors.CYAN}ℹ {text}{Colors.END}")
+    sys.stdout.write(_INFO_PREFIX + text + _END)
 
 
 def check_dependencies():
@@ -79,74 +146,197 @@ def check_dependencies():
     return True
 
 
-def get_video_metadata(filepath: Path) -> Dict:
-    """Extract metadata from video file using ffprobe"""
+def parse_frame_rate(rate: str) -> float:
+    """Parse an ffprobe frame rate such as '60000/1001'"""
+    num, _, den = rate.partition('/')
+    return int(num) / int(den) if den else float(num)
+
+
+def parse_creation_time(value: str) -> Optional[datetime]:
+    """Parse an ISO 8601 creation time tag, or return None if it is not one"""
+    for fmt in ISO_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    
+    # Other ISO forms, e.g. a space separator or a date-only tag
     try:
-        cmd = [
-            'ffprobe',
-            '-v', 'quiet',
-            '-print_format', 'json',
-            '-show_format',
-            '-show_streams',
-            str(filepath)
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        metadata = json.loads(result.stdout)
-        
-        # Get creation time from metadata or file stats
-        creation_time = None
-        if 'format' in metadata and 'tags' in metadata['format']:
-            tags = metadata['format']['tags']
-            # Try different tag names
-            for tag in ['creation_time', 'date', 'com.apple.quicktime.creationdate']:
-                if tag in tags:
-                    try:
-                        creation_time = datetime.fromisoformat(tags[tag].replace('Z', '+00:00'))
-                        break
-                    except:
-                        pass
-        
-        # Fallback to file modification time
-        if not creation_time:
-            creation_time = datetime.fromtimestamp(filepath.stat().st_mtime)
-        
-        # Get video duration
-        duration = float(metadata['format']['duration'])
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def load_metadata_cache() -> Dict:
+    """Load cached ffprobe results"""
+    try:
+        with open(METADATA_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_metadata_cache(cache: Dict):
+    """Atomically write cached ffprobe results"""
+    tmp_path = METADATA_CACHE.with_suffix('.tmp')
+    try:
+        METADATA_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, METADATA_CACHE)
+    except OSError:
+        # Caching is best effort
+        pass
+
+
+def prune_metadata_cache(cache: Dict, directory: Path, video_files: List[Dict]) -> Dict:
+    """Drop cache entries for files modified since, or missing from this directory"""
+    # Keep only the newest entry per file
+    latest = {}
+    for key in cache:
+        path, mtime_ns, _ = key.rsplit(':', 2)
+        if path not in latest or int(mtime_ns) > int(latest[path].rsplit(':', 2)[1]):
+            latest[path] = key
+    
+    directory = directory.resolve()
+    found = {str(v['filepath'].resolve()) for v in video_files}
+    return {
+        key: cache[key] for path, key in latest.items()
+        if Path(path).parent != directory or path in found
+    }
+
+
+async def get_video_metadata(filepath: Path, limit: asyncio.Semaphore, cache: Dict = None,
+                             st: os.stat_result = None) -> Dict:
+    """Extract metadata from video file using ffprobe (or the metadata cache)
+    
+    limit caps how many ffprobe processes run at once.
+    """
+    try:
+        # A changed mtime or size invalidates the cached entry
+        if st is None:
+            st = os.stat(filepath)
+        key = f"{filepath.resolve()}:{st.st_mtime_ns}:{st.st_size}"
         
-        # Get video stream info
-        video_stream = next((s for s in metadata['streams'] if s['codec_type'] == 'video'), None)
+        if cache is not None and key in cache:
+            info = cache[key]
+        else:
+            # Only ask for the first video stream and the fields we use
+            cmd = [
+                'ffprobe',
+                '-v', 'quiet',
+                '-print_format', 'json',
+                '-select_streams', 'v:0',
+                '-show_entries', 'stream=codec_type,codec_name,width,height,r_frame_rate'
+                                 ':format=duration'
+                                 ':format_tags=creation_time,date,com.apple.quicktime.creationdate',
+                str(filepath)
+            ]
+            
+            # Parse the raw bytes directly (with orjson when it is installed)
+            async with limit:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                stdout, _ = await process.communicate()
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+            metadata = json_loads(stdout)
+            
+            # Get creation time from metadata or file stats
+            creation_time = None
+            if 'format' in metadata and 'tags' in metadata['format']:
+                tags = metadata['format']['tags']
+                # Try different tag names
+                for tag in ['creation_time', 'date', 'com.apple.quicktime.creationdate']:
+                    if tag in tags:
+                        creation_time = parse_creation_time(tags[tag])
+                        if creation_time:
+                            break
+            
+            # Fallback to file modification time
+            if not creation_time:
+                creation_time = datetime.fromtimestamp(st.st_mtime)
+            
+            # Get video duration
+            duration = float(metadata['format']['duration'])
+            
+            # Get video stream info
+            video_stream = next((s for s in metadata['streams'] if s['codec_type'] == 'video'), None)
+            
+            info = {
+                'creation_time': creation_time.isoformat(),
+                'duration': duration,
+                'width': video_stream.get('width', 0) if video_stream else 0,
+                'height': video_stream.get('height', 0) if video_stream else 0,
+                'codec': video_stream.get('codec_name', 'unknown') if video_stream else 'unknown',
+                'fps': parse_frame_rate(video_stream.get('r_frame_rate', '30/1')) if video_stream else 30
+            }
+            if cache is not None:
+                cache[key] = info
         
         return {
             'filepath': filepath,
-            'creation_time': creation_time,
-            'duration': duration,
-            'width': video_stream.get('width', 0) if video_stream else 0,
-            'height': video_stream.get('height', 0) if video_stream else 0,
-            'codec': video_stream.get('codec_name', 'unknown') if video_stream else 'unknown',
-            'fps': eval(video_stream.get('r_frame_rate', '30/1')) if video_stream else 30
+            'creation_time': datetime.fromisoformat(info['creation_time']),
+            'duration': info['duration'],
+            'width': info['width'],
+            'height': info['height'],
+            'codec': info['codec'],
+            'fps': info['fps']
         }
     except Exception as e:
         print_error(f"Error reading metadata from {filepath.name}: {e}")
         return None
 
 
+async def probe_videos(candidates: List[Tuple[Path, os.stat_result]], cache: Dict) -> List[Dict]:
+    """Probe all candidate files concurrently, keeping those that could be read"""
+    # ffprobe runs are I/O bound, so they are all awaited together
+    limit = asyncio.Semaphore(MAX_CONCURRENT_PROBES)
+    results = await asyncio.gather(*(get_video_metadata(path, limit, cache, st)
+                                     for path, st in candidates))
+    return [metadata for metadata in results if metadata]
+
+
 def find_gopro_videos(directory: Path) -> List[Dict]:
     """Find all GoPro video files and sort by creation time"""
     print_info(f"Scanning directory: {directory}")
     
-    video_files = []
-    extensions = {'.mp4', '.MP4'}
+    # scandir reports the file type from the directory listing, and the
+    # entry's stat is reused for the cache key (.mp4 in any case)
+    with os.scandir(directory) as it:
+        candidates = [(Path(entry.path), entry.stat()) for entry in it
+                      if entry.name.lower().endswith('.mp4') and entry.is_file()]
+    cache = load_metadata_cache()
+    
+    video_files = asyncio.run(probe_videos(candidates, cache))
     
-    for filepath in directory.iterdir():
-        if filepath.is_file() and filepath.suffix in extensions:
-            metadata = get_video_metadata(filepath)
-            if metadata:
-                video_files.append(metadata)
-                print(f"  Found: {filepath.name} - {metadata['creation_time'].strftime('%Y-%m-%d %H:%M:%S')}")
+    save_metadata_cache(prune_metadata_cache(cache, directory, video_files))
     
-    # Sort by creation time
+    for metadata in video_files:
+        print(f"  Found: {metadata['filepath'].name} - {metadata['creation_time'].strftime('%Y-%m-%d %H:%M:%S')}")
+    
+    # Sort by creation time, or by recording and chapter for camera files
     video_files.sort(key=lambda x: x['creation_time'])
+    names = [GOPRO_NAME_PATTERN.match(v['filepath'].name) for v in video_files]
+    if video_files and all(names):
+        # A recording is its prefix family and clip number (GOPR files are
+        # the first chapter of a GP recording); chapters go in number order
+        recordings = {}
+        for metadata, name in zip(video_files, names):
+            prefix, chapter, clip = name.groups()
+            family = 'GP' if prefix.upper() == 'GOPR' else prefix.upper()
+            recordings.setdefault((family, clip), []).append((int(chapter or 0), metadata))
+        chapters = [[metadata for _, metadata in sorted(recording, key=lambda c: c[0])]
+                    for recording in recordings.values()]
+        
+        # Recordings are ordered by time; if two of them overlap in time
+        # (e.g. one clip number from two cameras) the names are ambiguous
+        # and the creation time order is kept
+        spans = sorted((min(v['creation_time'] for v in recording),
+                        max(v['creation_time'] for v in recording), index)
+                       for index, recording in enumerate(chapters))
+        if all(previous[1] < following[0] for previous, following in zip(spans, spans[1:])):
+            video_files = [metadata for _, _, index in spans for metadata in chapters[index]]
     
     return video_files
 
@@ -229,8 +419,9 @@ def get_user_choices() -> Dict:
         print("  2. p4 (balanced)")
         print("  3. p7 (slower, best quality)")
         preset_choice = input(f"{Colors.CYAN}Select [1-3] (default: 2): {Colors.END}").strip() or "2"
-        preset_map = {'1': 'p1', '2': 'p4', '3': 'p7'}
-        choices['preset'] = preset_map.get(preset_choice, 'p4')
+        # Preset and matching tuning: p1 trades quality for latency
+        preset_map = {'1': ('p1', 'ull'), '2': ('p4', 'hq'), '3': ('p7', 'hq')}
+        choices['preset'], choices['tune'] = preset_map.get(preset_choice, preset_map['2'])
     else:
         choices['preset'] = 'medium'
     
@@ -246,56 +437,57 @@ def create_concat_file(video_files: List[Dict], output_dir: Path) -> Path:
     """Create FFmpeg concat file for merging"""
     concat_file = output_dir / "concat_list.txt"
     
+    # Canonical absolute paths, single-quoted. FFmpeg reads quoted text
+    # literally, so an embedded quote is written as '\'' (close, escaped
+    # quote, reopen)
+    lines = []
+    for video in video_files:
+        filepath = os.fspath(video['filepath'].resolve()).replace("'", "'\\''")
+        lines.append(f"file '{filepath}'\n")
+    
     with open(concat_file, 'w') as f:
-        for video in video_files:
-            # Use absolute paths and escape special characters
-            filepath = str(video['filepath'].absolute()).replace("'", "'\\''")
-            f.write(f"file '{filepath}'\n")
+        f.write(''.join(lines))
     
     return concat_file
 
 
-def merge_videos(video_files: List[Dict], output_dir: Path, choices: Dict):
-    """Merge videos using FFmpeg with NVENC"""
-    
-    # Create output directory
-    output_dir.mkdir(exist_ok=True)
-    
-    # Generate output filename
-    first_date = video_files[0]['creation_time'].strftime('%Y%m%d')
-    codec_name = choices['codec'].replace('_nvenc', '').replace('lib', '')
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    output_file = output_dir / f"gopro_merged_{first_date}_{codec_name}_{timestamp}.mp4"
-    
-    # Create concat file
-    concat_file = create_concat_file(video_files, output_dir)
-    
-    print_header("STARTING VIDEO MERGE")
-    print_info(f"Output file: {output_file.name}")
-    print_info(f"Number of clips: {len(video_files)}")
-    total_duration = sum(v['duration'] for v in video_files)
-    print_info(f"Total duration: {format_duration(total_duration)}")
-    print()
-    
-    # Build FFmpeg command
-    cmd = ['ffmpeg', '-y']
-    
-    # Input
-    cmd.extend(['-f', 'concat', '-safe', '0', '-i', str(concat_file)])
+def build_ffmpeg_args(choices: Dict, transforms: Path = None) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """Build the input-side and output-side FFmpeg arguments for the encode
+    
+    With stabilization enabled, transforms is the vidstabdetect result for the clips.
+    """
+    input_args = []
+    output_args = []
+    
+    # Decode on the GPU and keep frames in GPU memory through to NVENC,
+    # unless a CPU-only filter (vidstab) is needed
+    gpu_pipeline = choices['use_nvenc'] and not choices['stabilization']
+    if gpu_pipeline:
+        # One named CUDA device shared by the decoder and the filters, with
+        # spare frames so the decoder does not stall behind scale_cuda/NVENC
+        input_args.extend([
+            '-init_hw_device', 'cuda=gpu0:0',
+            '-filter_hw_device', 'gpu0',
+            '-hwaccel', 'cuda',
+            '-hwaccel_device', 'gpu0',
+            '-hwaccel_output_format', 'cuda',
+            '-extra_hw_frames', '8',
+        ])
     
     # Video filters
     vfilters = []
     
     # Stabilization (if requested)
     if choices['stabilization']:
-        print_info("Note: Stabilization requires two-pass processing and will take longer")
-        # For simplicity, we'll skip the detect pass in this version
-        # You can add vidstabdetect + vidstabtransform if needed
-        vfilters.append('vidstabtransform=smoothing=30:zoom=5')
+        vfilters.append(f'vidstabtransform=input={transforms}:smoothing=30:zoom=5')
+        vfilters.append('unsharp=5:5:0.8')
     
     # Resolution
     if choices['resolution']:
-        vfilters.append(f"scale={choices['resolution']}:flags=lanczos")
+        if gpu_pipeline:
+            vfilters.append(f"scale_cuda={choices['resolution']}")
+        else:
+            vfilters.append(f"scale={choices['resolution']}:flags=lanczos")
     
     # Frame rate
     if choices['fps']:
@@ -303,86 +495,212 @@ def merge_videos(video_files: List[Dict], output_dir: Path, choices: Dict):
     
     # Apply filters
     if vfilters:
-        cmd.extend(['-vf', ','.join(vfilters)])
+        output_args.extend(['-vf', ','.join(vfilters)])
     
     # Video encoding
-    cmd.extend(['-c:v', choices['codec']])
+    output_args.extend(['-c:v', choices['codec']])
     
     if choices['use_nvenc']:
         # NVENC specific settings
-        cmd.extend([
+        output_args.extend([
             '-preset', choices['preset'],
-            '-b:v', choices['bitrate'],
+            '-tune', choices['tune'],
+            '-rc', 'vbr',
+        ])
+        
+        if choices['preset'] == 'p7':
+            # Constant quality, with the bitrate as a ceiling
+            output_args.extend(['-cq', str(NVENC_P7_CQ), '-b:v', '0'])
+        else:
+            output_args.extend(['-b:v', choices['bitrate']])
+        output_args.extend([
             '-maxrate', choices['bitrate'],
             '-bufsize', f"{int(choices['bitrate'][:-1]) * 2}M",
-            '-rc', 'vbr',
-            '-rc-lookahead', '32',
-            '-spatial-aq', '1',
-            '-temporal-aq', '1',
         ])
         
+        # Lookahead and adaptive quantization cost encoder time, so they
+        # are only used by the quality-oriented presets
+        if choices['preset'] in NVENC_HQ_PRESETS:
+            output_args.extend([
+                '-rc-lookahead', '32',
+                '-spatial-aq', '1',
+                '-temporal-aq', '1',
+            ])
+        
         if 'hevc' in choices['codec']:
-            cmd.extend(['-tier', 'high'])
+            output_args.extend(['-tier', 'high'])
     else:
         # CPU encoding settings
-        cmd.extend([
+        output_args.extend([
             '-preset', choices['preset'],
             '-crf', '23',
             '-b:v', choices['bitrate'],
         ])
     
     # Audio encoding
-    cmd.extend(['-c:a', 'aac', '-b:a', '192k'])
+    output_args.extend(['-c:a', 'aac', '-b:a', '192k'])
     
-    # Output
-    cmd.append(str(output_file))
+    return tuple(input_args), tuple(output_args)
+
+
+def all_inputs_same_codec_params(video_files: List[Dict]) -> bool:
+    """Check if all clips share codec, resolution and frame rate"""
+    return len({(v['codec'], v['width'], v['height'], v['fps']) for v in video_files}) == 1
+
+
+def can_stream_copy(video_files: List[Dict], choices: Dict) -> bool:
+    """Check if the clips can be joined as-is, without re-encoding"""
+    return (not choices['resolution']
+            and not choices['fps']
+            and not choices['stabilization']
+            and all_inputs_same_codec_params(video_files)
+            and CODEC_FORMATS.get(choices['codec']) == video_files[0]['codec'])
+
+
+def run_ffmpeg(cmd: List[str], total_duration: float) -> bool:
+    """Run FFmpeg, showing its progress against the total duration"""
+    # A deep progress pipe keeps FFmpeg from blocking on a slow repaint
+    popen_options = {}
+    if sys.version_info >= (3, 10):
+        popen_options['pipesize'] = PROGRESS_PIPE_SIZE
+    
+    # stderr is kept for reporting failures
+    with tempfile.TemporaryFile() as error_log:
+        process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=error_log,
+            bufsize=0,
+            # Nothing we open is inheritable, so skip closing every fd on Linux
+            close_fds=not sys.platform.startswith('linux'),
+            **popen_options
+        )
+        
+        try:
+            # Monitor progress: key=value lines read in chunks, each block ends with progress=
+            progress = {}
+            last_paint = 0.0
+            pending = b''
+            while True:
+                chunk = process.stdout.read(8192)
+                if not chunk:
+                    break
+                complete, _, pending = (pending + chunk).rpartition(b'\n')
+                for key, value in PROGRESS_PATTERN.findall(complete):
+                    if key != b'progress':
+                        progress[key] = value.strip()
+                        continue
+                    # Repaint at most every PROGRESS_INTERVAL, and always at the end
+                    now = time.monotonic()
+                    if now - last_paint < PROGRESS_INTERVAL and value != b'end':
+                        continue
+                    last_paint = now
+                    out_time = int(progress[b'out_time_us']) / 1000000 if progress.get(b'out_time_us', b'').isdigit() else 0
+                    percent = out_time / total_duration * 100 if total_duration else 0
+                    print(f"{_PROGRESS_PREFIX}frame={progress.get(b'frame', b'0').decode()} "
+                          f"fps={progress.get(b'fps', b'0').decode()} "
+                          f"time={format_duration(out_time)} ({percent:5.1f}%) "
+                          f"speed={progress.get(b'speed', b'N/A').decode()}{Colors.END}", end='', flush=True)
+            
+            process.wait()
+        except KeyboardInterrupt:
+            process.kill()
+            raise
+        print()  # New line after progress
+        
+        if process.returncode != 0:
+            error_log.seek(0)
+            for line in error_log.read().decode(errors='replace').splitlines()[-5:]:
+                print(f"  {line}")
+            return False
+    
+    return True
+
+
+def merge_videos(video_files: List[Dict], output_dir: Path, choices: Dict):
+    """Merge videos using FFmpeg with NVENC"""
+    
+    # Create output directory
+    output_dir.mkdir(exist_ok=True)
+    
+    # Generate output filename
+    first_date = video_files[0]['creation_time'].strftime('%Y%m%d')
+    codec_name = choices['codec'].replace('_nvenc', '').replace('lib', '')
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_file = output_dir / f"gopro_merged_{first_date}_{codec_name}_{timestamp}.mp4"
+    
+    # Create concat file
+    concat_file = create_concat_file(video_files, output_dir)
+    
+    print_header("STARTING VIDEO MERGE")
+    print_info(f"Output file: {output_file.name}")
+    print_info(f"Number of clips: {len(video_files)}")
+    total_duration = sum(v['duration'] for v in video_files)
+    print_info(f"Total duration: {format_duration(total_duration)}")
+    print()
+    
+    transforms = None
+    if choices.get('stream_copy'):
+        # Inputs already match the requested output - join without re-encoding
+        print_info("Stream copy: joining clips without re-encoding")
+        input_args, output_args = (), ('-c', 'copy')
+    else:
+        if choices['stabilization']:
+            print_info("Note: Stabilization requires two-pass processing and will take longer")
+            if choices['use_nvenc']:
+                print_info("Note: vidstab runs on the CPU, so decoding and scaling move off the GPU")
+            fd, transforms = tempfile.mkstemp(suffix='.trf')
+            os.close(fd)
+            transforms = Path(transforms)
+            detect_cmd = ['ffmpeg', '-y', '-nostats', '-progress', 'pipe:1',
+                          *CONCAT_INPUT_ARGS, '-i', str(concat_file),
+                          '-vf', f'vidstabdetect=shakiness=5:accuracy=15:result={transforms}',
+                          '-f', 'null', '-']
+        input_args, output_args = build_ffmpeg_args(choices, transforms)
+    
+    # Build FFmpeg command (machine-readable progress on stdout)
+    cmd = ['ffmpeg', '-y', '-nostats', '-progress', 'pipe:1',
+           *input_args, *CONCAT_INPUT_ARGS, '-i', str(concat_file),
+           *output_args, str(output_file)]
     
     print_info("FFmpeg command:")
     print(f"{Colors.YELLOW}{' '.join(cmd)}{Colors.END}\n")
     
-    # Execute FFmpeg
     try:
+        # Pass 1: analyze camera motion across the joined clips
+        if transforms:
+            print_info("Pass 1/2: analyzing camera motion...")
+            if not run_ffmpeg(detect_cmd, total_duration):
+                print_error("Motion analysis failed!")
+                return None
+            print_info("Pass 2/2: stabilizing and encoding...")
+        
         print_info("Encoding in progress... This may take a while.")
         print()
         
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1
-        )
-        
-        # Monitor progress
-        for line in process.stdout:
-            if 'frame=' in line or 'time=' in line:
-                print(f"\r{Colors.CYAN}{line.strip()}{Colors.END}", end='', flush=True)
-        
-        process.wait()
-        print()  # New line after progress
-        
-        if process.returncode == 0:
-            print_success(f"Video merged successfully!")
-            print_success(f"Output: {output_file}")
-            
-            # Show file size
-            size_mb = output_file.stat().st_size / (1024 * 1024)
-            print_info(f"File size: {size_mb:.2f} MB")
-        else:
+        if not run_ffmpeg(cmd, total_duration):
             print_error("FFmpeg encoding failed!")
             return None
+        
+        print_success(f"Video merged successfully!")
+        print_success(f"Output: {output_file}")
+        
+        # Show file size
+        size_mb = output_file.stat().st_size / (1024 * 1024)
+        print_info(f"File size: {size_mb:.2f} MB")
             
     except KeyboardInterrupt:
         print_error("\nEncoding interrupted by user!")
-        process.kill()
         return None
     except Exception as e:
         print_error(f"Error during encoding: {e}")
         return None
     finally:
-        # Cleanup concat file
+        # Cleanup concat and transforms files
         if concat_file.exists():
             concat_file.unlink()
+        if transforms and transforms.exists():
+            transforms.unlink()
     
     return output_file
 
@@ -432,6 +750,14 @@ def main():
     # Get encoding options
     choices = get_user_choices()
     
+    # Joining without re-encoding keeps the source bitrate, so ask first
+    choices['stream_copy'] = False
+    if can_stream_copy(video_files, choices):
+        print()
+        print_info("Clips already match the selected codec, resolution and frame rate.")
+        copy_choice = input(f"{Colors.CYAN}Join without re-encoding (much faster, keeps original bitrate)? [Y/n]: {Colors.END}").strip().lower()
+        choices['stream_copy'] = not copy_choice or copy_choice == 'y'
+    
     # Set output directory
     output_dir = input_dir / "merged_output"
     